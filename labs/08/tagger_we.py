@@ -38,24 +38,48 @@ class TrainableModule(torch.nn.Module):
     from torch.utils.tensorboard import SummaryWriter as _SummaryWriter
     from time import time as _time
     from tqdm import tqdm as _tqdm
+    from contextlib import nullcontext as _nullcontext
 
-    def configure(self, *, optimizer=None, schedule=None, loss=None, metrics={}, logdir=None, device="auto"):
+    amp_dtype = None  # Set by `configure`, but also needed by `predict` after just `load_weights`.
+
+    def configure(self, *, optimizer=None, schedule=None, loss=None, metrics={}, logdir=None, device="auto",
+                  amp_dtype=None, log_every_n_steps=50, compile_forward=False, grad_accumulation_steps=1):
         """Configure the module process.
 
         - `optimizer` is the optimizer to use for training;
-        - `schedule` is an optional learning rate scheduler used after every batch;
+        - `schedule` is an optional learning rate scheduler used after every optimizer step;
         - `loss` is the loss function to minimize;
         - `metrics` is a dictionary of additional metrics to compute;
         - `logdir` is an optional directory where TensorBoard logs should be written;
-        - `device` is the device to use; when "auto", `cuda` is used when available, `cpu` otherwise.
+        - `device` is the device to use; when "auto", `cuda` is used when available, `cpu` otherwise;
+        - `amp_dtype` is an optional `torch.bfloat16` or `torch.float16` enabling mixed precision;
+          with `torch.float16`, the loss is scaled using a gradient scaler;
+        - `log_every_n_steps` is how often the running loss and metrics are recomputed
+          during training; they are always recomputed at the end of every epoch;
+        - `compile_forward` controls whether the `forward` method is compiled using `torch.compile`;
+          it can be either `True` or a dictionary of additional `torch.compile` arguments;
+        - `grad_accumulation_steps` is the number of batches whose gradients are accumulated
+          before every optimizer step.
         """
+        self.device = torch.device(("cuda" if torch.cuda.is_available() else "cpu") if device == "auto" else device)
         self.optimizer = optimizer
         self.schedule = schedule
-        self.loss, self.loss_metric = loss, torchmetrics.MeanMetric()
-        self.metrics = torchmetrics.MetricCollection(metrics)
+        self.loss, self.loss_metric = loss, torchmetrics.MeanMetric().to(self.device)
+        self.metrics = torchmetrics.MetricCollection(metrics, compute_groups=True).to(self.device)
         self.logdir, self._writers = logdir, {}
-        self.device = torch.device(("cuda" if torch.cuda.is_available() else "cpu") if device == "auto" else device)
+        self.grad_accumulation_steps, self._accumulated_batches = grad_accumulation_steps, 0
+        self.log_every_n_steps, self._metric_steps, self._metric_logs = log_every_n_steps, 0, {}
+        self.amp_dtype = amp_dtype
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16 and self.device.type == "cuda")
         self.to(self.device)
+        if compile_forward:
+            # Always compile the original `forward`, even when `configure` is called repeatedly.
+            self._orig_forward = getattr(self, "_orig_forward", self.forward)
+            compile_args = {"mode": "reduce-overhead", "dynamic": True} \
+                | (compile_forward if compile_forward is not True else {})
+            self.forward = torch.compile(self._orig_forward, **compile_args)
+        else:
+            vars(self).pop("forward", None)  # Drop a `forward` compiled by a previous `configure`.
 
     def load_weights(self, path, device="auto"):
         """Load the model weights from the given path."""
@@ -71,7 +95,9 @@ class TrainableModule(torch.nn.Module):
         """Train the model on the given dataset.
 
         - `dataloader` is the training dataset, each element a pair of inputs and an output;
-          the inputs can be either a single tensor or a tuple of tensors;
+          the inputs can be either a single tensor or a tuple of tensors; the batches are
+          copied to the device asynchronously, so pass `pin_memory=True` to the `DataLoader`
+          to overlap the host-to-GPU copies with the computation;
         - `dev` is an optional development dataset;
         - `epochs` is the number of epochs to train;
         - `callbacks` is a list of callbacks to call after each epoch with
@@ -83,15 +109,31 @@ class TrainableModule(torch.nn.Module):
             self.train()
             self.loss_metric.reset()
             self.metrics.reset()
+            self._metric_steps = 0
             start = self._time()
             epoch_message = f"Epoch={epoch+1}/{epochs}"
             data_and_progress = self._tqdm(
                 dataloader, epoch_message, unit="batch", leave=False, disable=None if verbose == 2 else not verbose)
-            for xs, y in data_and_progress:
-                xs, y = tuple(x.to(self.device) for x in (xs if isinstance(xs, tuple) else (xs,))), y.to(self.device)
-                logs = self.train_step(xs, y)
-                message = [epoch_message] + [f"{k}={v:.{0<abs(v)<2e-4 and '3g' or '4f'}}" for k, v in logs.items()]
-                data_and_progress.set_description(" ".join(message), refresh=False)
+            refresh_every = max(1, (data_and_progress.total or 0) // 100)
+            for step, (xs, y) in enumerate(data_and_progress):
+                xs = tuple(x.to(self.device, non_blocking=True) for x in (xs if isinstance(xs, tuple) else (xs,)))
+                y = y.to(self.device, non_blocking=True)
+                if self.grad_accumulation_steps > 1:
+                    accumulate = (step + 1) % self.grad_accumulation_steps != 0 and step + 1 != data_and_progress.total
+                    logs = self.train_step(xs, y, accumulate=accumulate)
+                else:
+                    logs = self.train_step(xs, y)
+                if step % refresh_every == 0 and not data_and_progress.disable:
+                    message = [epoch_message] + [f"{k}={v:.{0<abs(v)<2e-4 and '3g' or '4f'}}"
+                                                 for k, v in ((k, float(v)) for k, v in logs.items())]
+                    data_and_progress.set_description(" ".join(message), refresh=False)
+            if self._accumulated_batches:
+                # Without a known epoch length, the last accumulated gradients are still pending.
+                with torch.no_grad():
+                    self._optimizer_step()
+            logs |= {"loss": self.loss_metric.compute()} \
+                | ({"lr": self.schedule.get_last_lr()[0]} if self.schedule else {}) \
+                | self.metrics.compute()
             if dev is not None:
                 logs |= {"dev_" + k: v for k, v in self.evaluate(dev, verbose=0).items()}
             for callback in callbacks:
@@ -102,22 +144,45 @@ class TrainableModule(torch.nn.Module):
                               *[f"{k}={v:.{0<abs(v)<2e-4 and '3g' or '4f'}}" for k, v in logs.items()])
         return logs
 
-    def train_step(self, xs, y):
+    def train_step(self, xs, y, accumulate=False):
         """An overridable method performing a single training step.
 
-        A dictionary with the loss and metrics should be returned."""
-        self.zero_grad()
-        y_pred = self.forward(*xs)
-        loss = self.loss(y_pred, y)
-        loss.backward()
+        When `accumulate` is set, the gradients are only accumulated without
+        updating the weights. A dictionary with the loss and metrics should be
+        returned; the running loss and metrics are recomputed only every
+        `log_every_n_steps` steps."""
+        with self._autocast():
+            y_pred = self.forward(*xs)
+            loss = self.loss(y_pred, y)
+        self.scaler.scale(loss / self.grad_accumulation_steps).backward()
+        self._accumulated_batches += 1
         with torch.no_grad():
-            self.optimizer.step()
-            self.schedule is not None and self.schedule.step()
-            self.loss_metric.update(loss)
-            self.metrics.update(y_pred, y)
-            return {"loss": self.loss_metric.compute()} \
-                | ({"lr": self.schedule.get_last_lr()[0]} if self.schedule else {}) \
-                | self.metrics.compute()
+            accumulate or self._optimizer_step()
+            self.loss_metric.update(loss.detach().float())
+            self.metrics.update(y_pred.detach().float(), y)
+            if self._metric_steps % self.log_every_n_steps == 0:
+                self._metric_logs = {"loss": self.loss_metric.compute()} \
+                    | ({"lr": self.schedule.get_last_lr()[0]} if self.schedule else {}) \
+                    | self.metrics.compute()
+            self._metric_steps += 1
+            return dict(self._metric_logs)
+
+    def _optimizer_step(self):
+        """Update the weights using the accumulated gradients, and reset them."""
+        if self._accumulated_batches != self.grad_accumulation_steps:
+            # Average the gradients of a partial group of batches over its actual size.
+            for group in self.optimizer.param_groups:
+                for parameter in group["params"]:
+                    if parameter.grad is not None:
+                        parameter.grad.mul_(self.grad_accumulation_steps / self._accumulated_batches)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+        self._accumulated_batches = 0
+        # As in the PyTorch AMP recipe, the schedule is stepped even when the float16 gradient
+        # scaler skips the optimizer step on inf/NaN gradients, because detecting a skipped
+        # step would require a GPU-to-host synchronization after every step.
+        self.schedule is not None and self.schedule.step()
 
     def evaluate(self, dataloader, verbose=1):
         """An evaluation of the model on the given dataset.
@@ -129,7 +194,8 @@ class TrainableModule(torch.nn.Module):
         self.loss_metric.reset()
         self.metrics.reset()
         for xs, y in dataloader:
-            xs, y = tuple(x.to(self.device) for x in (xs if isinstance(xs, tuple) else (xs,))), y.to(self.device)
+            xs = tuple(x.to(self.device, non_blocking=True) for x in (xs if isinstance(xs, tuple) else (xs,)))
+            y = y.to(self.device, non_blocking=True)
             logs = self.test_step(xs, y)
         verbose and print("Evaluation", *[f"{k}={v:.{0<abs(v)<2e-4 and '3g' or '4f'}}" for k, v in logs.items()])
         return logs
@@ -138,10 +204,10 @@ class TrainableModule(torch.nn.Module):
         """An overridable method performing a single evaluation step.
 
         A dictionary with the loss and metrics should be returned."""
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             y_pred = self.forward(*xs)
-            self.loss_metric.update(self.loss(y_pred, y))
-            self.metrics.update(y_pred, y)
+            self.loss_metric.update(self.loss(y_pred, y).float())
+            self.metrics.update(y_pred.float(), y)
             return {"loss": self.loss_metric.compute()} | self.metrics.compute()
 
     def predict(self, dataloader, as_numpy=True):
@@ -157,18 +223,55 @@ class TrainableModule(torch.nn.Module):
         of the individual examples. Note that if the input was padded, so
         will be the predictions, which will then need to be trimmed."""
         self.eval()
-        predictions = []
-        for batch in dataloader:
-            xs = batch[0] if isinstance(batch, tuple) else batch
-            xs = tuple(x.to(self.device) for x in (xs if isinstance(xs, tuple) else (xs,)))
-            batch = self.predict_step(xs)
-            predictions.extend(batch.numpy(force=True) if as_numpy else batch)
-        return predictions
+        batches = []
+        # On CUDA, the predictions are copied to the host on a separate stream through two alternating
+        # pinned staging buffers, so that the copy of a batch overlaps with the computation of the next one.
+        # The device predictions stay referenced in `batches` until their copy finishes, so they cannot be
+        # freed and reused while being copied.
+        copy_stream = torch.cuda.Stream(self.device) if as_numpy and self.device.type == "cuda" else None
+        staging, pending = [None, None], None
+        with torch.inference_mode():
+            for batch in dataloader:
+                xs = batch[0] if isinstance(batch, tuple) else batch
+                xs = tuple(x.to(self.device, non_blocking=True) for x in (xs if isinstance(xs, tuple) else (xs,)))
+                batch = self.predict_step(xs)
+                if "forward" in vars(self):
+                    # The outputs of a compiled `forward` can be overwritten by its next run (CUDA graphs).
+                    batch = batch.clone()
+                if copy_stream is not None and batch.is_cuda:
+                    if pending is not None:
+                        index, event, host = pending
+                        event.synchronize()
+                        batches[index], pending = host.clone(), None
+                    slot = len(batches) % 2
+                    if staging[slot] is None or staging[slot].numel() < batch.nbytes:
+                        staging[slot] = torch.empty(batch.nbytes, dtype=torch.uint8, pin_memory=True)
+                    host = staging[slot][:batch.nbytes].view(batch.dtype).view(batch.shape)
+                    copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+                    with torch.cuda.stream(copy_stream):
+                        host.copy_(batch, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(copy_stream)
+                    pending = len(batches), event, host
+                batches.append(batch)
+            if pending is not None:
+                index, event, host = pending
+                event.synchronize()
+                batches[index] = host.clone()
+        return [example for batch in batches for example in (batch.numpy(force=True) if as_numpy else batch)]
 
     def predict_step(self, xs):
         """An overridable method performing a single prediction step."""
-        with torch.no_grad():
-            return self.forward(*xs)
+        with torch.inference_mode(), self._autocast():
+            y_pred = self.forward(*xs)
+            # Return the mixed precision outputs in float32, because NumPy does not support bfloat16.
+            return y_pred.float() if self.amp_dtype is not None and y_pred.is_floating_point() else y_pred
+
+    def _autocast(self):
+        """Return an autocast context when mixed precision is used, and a no-op context otherwise."""
+        if self.amp_dtype is None:
+            return self._nullcontext()
+        return torch.autocast(self.device.type, dtype=self.amp_dtype)
 
     def writer(self, writer):
         """Possibly create and return a TensorBoard writer for the given name."""
@@ -179,27 +282,49 @@ class TrainableModule(torch.nn.Module):
     def add_logs(self, writer, logs, step):
         """Log the given dictionary to TensorBoard with a given name and step number."""
         if logs and self.logdir:
+            writer = self.writer(writer)
             for key, value in logs.items():
-                self.writer(writer).add_scalar(key, value, step)
-            self.writer(writer).flush()
+                writer.add_scalar(key, float(value), step)
+            writer.flush()
 
     @staticmethod
     def keras_init(module):
         """Initialize weights using the Keras defaults."""
-        if isinstance(module, (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d,
-                               torch.nn.ConvTranspose1d, torch.nn.ConvTranspose2d, torch.nn.ConvTranspose3d)):
-            torch.nn.init.xavier_uniform_(module.weight)
-            if module.bias is not None:
-                torch.nn.init.zeros_(module.bias)
-        if isinstance(module, (torch.nn.Embedding, torch.nn.EmbeddingBag)):
-            torch.nn.init.uniform_(module.weight, -0.05, 0.05)
-        if isinstance(module, (torch.nn.RNNBase, torch.nn.RNNCellBase)):
-            for name, parameter in module.named_parameters():
-                "weight_ih" in name and torch.nn.init.xavier_uniform_(parameter)
-                "weight_hh" in name and torch.nn.init.orthogonal_(parameter)
-                "bias" in name and torch.nn.init.zeros_(parameter)
-                if "bias" in name and isinstance(module, (torch.nn.LSTM, torch.nn.LSTMCell)):
-                    parameter.data[module.hidden_size:module.hidden_size * 2] = 1
+        for module_type in type(module).__mro__:
+            if module_type in TrainableModule._KERAS_INITIALIZERS:
+                return TrainableModule._KERAS_INITIALIZERS[module_type](module)
+
+    @staticmethod
+    def _keras_init_linear(module):
+        """Initialize a linear or convolutional layer using the Keras defaults."""
+        torch.nn.init.xavier_uniform_(module.weight)
+        if module.bias is not None:
+            torch.nn.init.zeros_(module.bias)
+
+    @staticmethod
+    def _keras_init_embedding(module):
+        """Initialize an embedding layer using the Keras defaults."""
+        torch.nn.init.uniform_(module.weight, -0.05, 0.05)
+
+    @staticmethod
+    def _keras_init_rnn(module):
+        """Initialize a recurrent layer or cell using the Keras defaults."""
+        for name, parameter in module.named_parameters():
+            kind = TrainableModule._KERAS_RNN_PARAMETER.match(name)
+            kind = kind and kind.group()
+            kind == "weight_ih" and torch.nn.init.xavier_uniform_(parameter)
+            kind == "weight_hh" and torch.nn.init.orthogonal_(parameter)
+            kind == "bias" and torch.nn.init.zeros_(parameter)
+            if kind == "bias" and isinstance(module, (torch.nn.LSTM, torch.nn.LSTMCell)):
+                parameter.data[module.hidden_size:module.hidden_size * 2] = 1
+
+    _KERAS_RNN_PARAMETER = re.compile(r"weight_ih|weight_hh|bias")
+    _KERAS_INITIALIZERS = {
+        **dict.fromkeys((torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d, torch.nn.ConvTranspose1d,
+                         torch.nn.ConvTranspose2d, torch.nn.ConvTranspose3d), _keras_init_linear),
+        **dict.fromkeys((torch.nn.Embedding, torch.nn.EmbeddingBag), _keras_init_embedding),
+        **dict.fromkeys((torch.nn.RNNBase, torch.nn.RNNCellBase), _keras_init_rnn),
+    }
 
 
 class Model(TrainableModule):
@@ -297,8 +422,10 @@ def main(args: argparse.Namespace) -> dict[str, float]:
         # TODO: Process `tag_ids` analogously to `form_ids`.
         tag_ids = ...
         return form_ids, tag_ids
-    train = torch.utils.data.DataLoader(train, batch_size=args.batch_size, collate_fn=prepare_batch, shuffle=True)
-    dev = torch.utils.data.DataLoader(dev, batch_size=args.batch_size, collate_fn=prepare_batch)
+    train = torch.utils.data.DataLoader(train, batch_size=args.batch_size, collate_fn=prepare_batch, shuffle=True,
+                                        pin_memory=torch.cuda.is_available())
+    dev = torch.utils.data.DataLoader(dev, batch_size=args.batch_size, collate_fn=prepare_batch,
+                                      pin_memory=torch.cuda.is_available())
 
     model.configure(
         # TODO: Create the optimizer by creating an instance of